@@ -1,14 +1,30 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, redirect
 import json
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.mime.nonmultipart import MIMENonMultipart
 from apscheduler.schedulers.background import BackgroundScheduler
 import datetime
 import requests
 from bs4 import BeautifulSoup
 import os
 import logging
+import re
+import hmac
+import html
+import atexit
+import base64
+import hashlib
+import contextlib
+import collections
+from urllib.parse import quote
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 下没有 fcntl，订阅数据读写不加文件锁
+    fcntl = None
 
 # 配置日志
 handlers = []
@@ -72,6 +88,31 @@ def load_subscribers():
         logger.warning(f"订阅用户文件加载失败: {e}，返回空列表")
         return {"subscribers": []}
 
+# 跨进程文件锁，锁不可重入，持有锁期间不要再次获取同一个锁
+@contextlib.contextmanager
+def file_lock(lock_name):
+    lock_path = os.path.join(PROJECT_ROOT, lock_name)
+    try:
+        lock_file = open(lock_path, 'a')
+    except (OSError, PermissionError) as e:
+        # 在只读环境中（如Vercel），无法创建锁文件，被保护的数据文件同样无法写入
+        logger.warning(f"锁文件创建失败（只读环境）: {e}")
+        yield
+        return
+    
+    with lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# 订阅数据文件锁：所有“读取-修改-保存”订阅数据的地方（接口、定时发送、分片发送）都需要持有该锁
+def subscribers_lock():
+    return file_lock('subscribers.json.lock')
+
 # 保存订阅用户
 def save_subscribers(data):
     subscribers_path = os.path.join(PROJECT_ROOT, 'subscribers.json')
@@ -93,9 +134,17 @@ def save_subscribers(data):
 def save_news(news_data):
     news_path = os.path.join(PROJECT_ROOT, 'news.json')
     logger.info(f"保存新闻内容到文件: {news_path}")
+    # 保留已预热的邮件摘要快照，避免刷新新闻列表时覆盖
+    if 'digest' not in news_data:
+        digest = load_news().get('digest')
+        if digest:
+            news_data = {**news_data, "digest": digest}
     try:
-        with open(news_path, 'w', encoding='utf-8') as f:
+        # 先写临时文件再替换，避免并发读取时读到写了一半的文件
+        tmp_path = f"{news_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             json.dump(news_data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, news_path)
         logger.info(f"新闻内容保存成功，共 {len(news_data.get('news', []))} 条新闻")
         return True
     except (OSError, PermissionError) as e:
@@ -106,8 +155,56 @@ def save_news(news_data):
         logger.error(f"新闻内容保存失败: {e}")
         return False
 
-# 发送邮件
-def send_email(to_email, subject, content):
+# 投递失败类型
+FAILURE_PERMANENT = 'permanent'  # 5xx：收件地址被拒（不存在、已停用等）
+FAILURE_TRANSIENT = 'transient'  # 4xx 或网络异常：稍后重试可能成功
+
+# 默认的自动屏蔽阈值（连续失败次数）
+DEFAULT_BOUNCE_CONFIG = {
+    "permanent_failure_threshold": 1,
+    "transient_failure_threshold": 5
+}
+
+# 根据SMTP响应码对收件人失败进行分类
+# 只有RCPT阶段被拒（SMTPRecipientsRefused）才与收件地址相关；连接、认证、发件人、DATA阶段的错误
+# （如内容被拒）以及网络异常都属于发件方问题，返回None，不计入收件人失败
+def classify_smtp_error(error, to_email=None):
+    if not isinstance(error, smtplib.SMTPRecipientsRefused):
+        return None
+    
+    recipients = error.recipients or {}
+    response = recipients.get(to_email) or next(iter(recipients.values()), None)
+    if not response:
+        return None
+    
+    if 500 <= response[0] < 600:
+        return FAILURE_PERMANENT
+    return FAILURE_TRANSIENT
+
+# 加载新闻内容
+def load_news():
+    news_path = os.path.join(PROJECT_ROOT, 'news.json')
+    logger.info(f"加载新闻内容文件: {news_path}")
+    try:
+        with open(news_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"新闻内容文件加载失败: {e}，返回空数据")
+        return {"news": []}
+
+# 对HTML正文进行MIME编码（base64），可预先计算后复用
+def encode_html_body(content):
+    return MIMEText(content, 'html', 'utf-8').get_payload()
+
+# 根据预编码的正文构建HTML邮件部分
+def build_html_part(encoded_body):
+    html_part = MIMENonMultipart('text', 'html', charset='utf-8')
+    html_part['Content-Transfer-Encoding'] = 'base64'
+    html_part.set_payload(encoded_body)
+    return html_part
+
+# 发送邮件并返回失败分类：(是否成功, 失败类型)
+def deliver_email(to_email, subject, content, encoded_body=None):
     logger.info(f"准备发送邮件到: {to_email}，主题: {subject}")
     config = load_config()    
     smtp_server = config['email']['smtp_server']
@@ -120,7 +217,10 @@ def send_email(to_email, subject, content):
     msg['To'] = to_email
     msg['Subject'] = subject
     
-    html_part = MIMEText(content, 'html', 'utf-8')
+    if encoded_body is not None:
+        html_part = build_html_part(encoded_body)
+    else:
+        html_part = MIMEText(content, 'html', 'utf-8')
     msg.attach(html_part)
     
     try:
@@ -136,16 +236,319 @@ def send_email(to_email, subject, content):
         server.send_message(msg)
         logger.info(f"邮件发送成功到: {to_email}")
         server.quit()
-        return True
-    except smtplib.SMTPAuthenticationError:
+        return True, None
+    except smtplib.SMTPAuthenticationError as e:
         logger.error("邮件发送失败: 认证错误，请检查邮箱账号和密码")
-        return False
-    except smtplib.SMTPConnectError:
+        return False, classify_smtp_error(e, to_email)
+    except smtplib.SMTPConnectError as e:
         logger.error("邮件发送失败: 连接错误，请检查SMTP服务器地址和端口")
+        return False, classify_smtp_error(e, to_email)
+    except Exception as e:
+        failure_type = classify_smtp_error(e, to_email)
+        logger.error(f"邮件发送失败: {e}（失败类型: {failure_type}）")
+        return False, failure_type
+
+# 发送邮件
+def send_email(to_email, subject, content):
+    success, _ = deliver_email(to_email, subject, content)
+    return success
+
+# 规范化邮箱地址（去除空白、转小写），用于同一地址的不同写法之间的比较
+def normalize_email(email):
+    return email.strip().lower()
+
+# 获取屏蔽列表（规范化地址集合，O(1)查询）
+def load_suppression_list(subscribers):
+    return {normalize_email(s['email']) for s in subscribers.get('subscribers', []) if s.get('status') == 'suppressed'}
+
+# 记录投递结果，更新订阅用户的连续失败计数，超过阈值时自动屏蔽
+def record_delivery_result(subscriber, success, failure_type, bounce_config, at=None):
+    now = at or datetime.datetime.now().isoformat()
+    
+    if success:
+        if subscriber.get('consecutive_failures'):
+            subscriber['consecutive_failures'] = 0
+            subscriber['updated_at'] = now
+            return True
+        return False
+    
+    # 发件方问题不计入收件人的失败次数
+    if failure_type is None:
         return False
+    
+    failures = subscriber.get('consecutive_failures', 0) + 1
+    subscriber['consecutive_failures'] = failures
+    subscriber['last_failure_type'] = failure_type
+    subscriber['last_failure_at'] = now
+    subscriber['updated_at'] = now
+    
+    if failure_type == FAILURE_PERMANENT:
+        threshold = bounce_config['permanent_failure_threshold']
+    else:
+        threshold = bounce_config['transient_failure_threshold']
+    
+    if failures >= threshold:
+        subscriber['status'] = 'suppressed'
+        subscriber['suppressed_at'] = now
+        logger.warning(f"邮箱 {subscriber['email']} 连续失败 {failures} 次（{failure_type}），已自动屏蔽")
+    
+    return True
+
+# 默认的打开/点击跟踪配置
+DEFAULT_TRACKING_CONFIG = {
+    "enabled": False,
+    "base_url": "http://your-domain.com",
+    "secret": "",                  # 跳转链接签名密钥，开启跟踪时必须配置
+    "flush_interval_seconds": 5,   # 内存事件批量写入事件文件的间隔
+    "inactive_days": 90            # 超过该天数没有打开/点击的用户在发送时跳过，0表示不跳过
+}
+
+# 邮件中的订阅用户标识占位符，发送时替换为每个用户的标识
+# 占位符与用户标识等长且长度为3的倍数，便于按base64分段预编码
+TRACKING_TOKEN_PLACEHOLDER = '__TRACKING_TOKEN__'
+TRACKING_TOKEN_LENGTH = len(TRACKING_TOKEN_PLACEHOLDER)
+
+# 1x1 透明GIF
+TRACKING_PIXEL = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+
+# 打开/点击事件文件（只追加）
+EVENTS_PATH = os.path.join(PROJECT_ROOT, 'events.jsonl')
+
+# 按用户标识汇总的打开/点击统计，每次写入事件时增量更新
+ENGAGEMENT_PATH = os.path.join(PROJECT_ROOT, 'engagement.json')
+
+TRACKING_EVENT_TYPES = ('open', 'click')
+TRACKING_TOKEN_PATTERN = re.compile(r'[0-9a-f]{%d}' % TRACKING_TOKEN_LENGTH)
+
+# 内存事件缓冲区，由定时任务批量写入事件文件
+TRACKING_BUFFER_SIZE = 100000
+tracking_events = collections.deque(maxlen=TRACKING_BUFFER_SIZE)
+# 缓冲区已满时丢弃的事件数，下次写入时记录日志
+tracking_stats = {"dropped": 0}
+_tracking_config = None
+
+# 合并默认值生成跟踪配置
+def build_tracking_config(config):
+    tracking_config = {**DEFAULT_TRACKING_CONFIG, **config.get('tracking', {})}
+    if tracking_config['enabled'] and not tracking_config['secret']:
+        logger.error("已开启邮件跟踪但未配置 tracking.secret，跟踪功能不会生效")
+        tracking_config['enabled'] = False
+    return tracking_config
+
+# 获取缓存的跟踪配置，避免跟踪接口每次请求都读取配置文件
+def get_tracking_config():
+    global _tracking_config
+    if _tracking_config is None:
+        _tracking_config = build_tracking_config(load_config())
+    return _tracking_config
+
+# 订阅用户标识：使用密钥的HMAC，既不暴露邮箱地址，也无法为已知地址伪造打开/点击事件
+def subscriber_token(email, secret):
+    return hmac.new(secret.encode('utf-8'), normalize_email(email).encode('utf-8'),
+                    hashlib.sha256).hexdigest()[:TRACKING_TOKEN_LENGTH]
+
+# 检查用户标识格式，格式不符的请求不记录事件
+def is_valid_token(token):
+    return bool(token) and TRACKING_TOKEN_PATTERN.fullmatch(token) is not None
+
+# 对跳转地址签名，防止跟踪链接被用作任意跳转
+def sign_tracking_url(url, secret):
+    return hmac.new(secret.encode('utf-8'), url.encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+# 将邮件中的链接改写为点击跟踪链接，并加入打开跟踪像素
+def add_tracking(content, tracking_config):
+    base_url = tracking_config['base_url'].rstrip('/')
+    
+    def replace_link(match):
+        url = html.unescape(match.group(2))
+        if not url.startswith(('http://', 'https://')):
+            return match.group(0)
+        tracked_url = (f"{base_url}/track/click?s={TRACKING_TOKEN_PLACEHOLDER}"
+                       f"&u={quote(url, safe='')}&sig={sign_tracking_url(url, tracking_config['secret'])}")
+        return f"href={match.group(1)}{html.escape(tracked_url)}{match.group(1)}"
+    
+    content = re.sub(r"""href=(['"])(.*?)\1""", replace_link, content)
+    content += f'<img src="{base_url}/track/open?s={TRACKING_TOKEN_PLACEHOLDER}" width="1" height="1" alt="">'
+    return content
+
+# 预编码邮件摘要：不含跟踪占位符时直接编码；含占位符时按占位符分段编码
+# base64 以3字节为一组，只要每段（最后一段除外）的字节数是3的倍数，分段编码后拼接与整体编码结果相同，
+# 因此在每段末尾所在标签前补空格对齐（HTML中标签之间的空格不影响显示）
+def build_digest(content):
+    if TRACKING_TOKEN_PLACEHOLDER not in content:
+        return {"content": content, "encoded_body": encode_html_body(content)}
+    
+    parts = content.split(TRACKING_TOKEN_PLACEHOLDER)
+    for i in range(len(parts) - 1):
+        padding = -len(parts[i].encode('utf-8')) % 3
+        if padding:
+            tag_start = max(parts[i].rfind('<'), 0)
+            parts[i] = parts[i][:tag_start] + ' ' * padding + parts[i][tag_start:]
+    
+    return {
+        "content": TRACKING_TOKEN_PLACEHOLDER.join(parts),
+        "encoded_parts": [base64.b64encode(part.encode('utf-8')).decode('ascii') for part in parts]
+    }
+
+# 为收件人生成个性化的邮件正文：(HTML内容, 预编码正文)，只需拼接预编码的分段和用户标识
+def personalize_digest(digest, email, secret):
+    if 'encoded_parts' not in digest:
+        return digest['content'], digest['encoded_body']
+    
+    token = subscriber_token(email, secret)
+    encoded = base64.b64encode(token.encode('ascii')).decode('ascii').join(digest['encoded_parts'])
+    encoded_body = ''.join(encoded[i:i + 76] + '\n' for i in range(0, len(encoded), 76))
+    return digest['content'].replace(TRACKING_TOKEN_PLACEHOLDER, token), encoded_body
+
+# 记录打开/点击事件到内存缓冲区
+def record_tracking_event(event_type, token, url=None):
+    if len(tracking_events) >= TRACKING_BUFFER_SIZE:
+        tracking_stats['dropped'] += 1
+    tracking_events.append({
+        "type": event_type,
+        "token": token,
+        "url": url,
+        "at": datetime.datetime.now().isoformat()
+    })
+
+# 将缓冲区中的事件批量追加写入事件文件
+def flush_tracking_events():
+    if tracking_stats['dropped']:
+        dropped, tracking_stats['dropped'] = tracking_stats['dropped'], 0
+        logger.warning(f"跟踪事件缓冲区已满，丢弃了 {dropped} 条最早的事件")
+    
+    events = []
+    while tracking_events:
+        try:
+            events.append(tracking_events.popleft())
+        except IndexError:
+            break
+    
+    if not events:
+        return 0
+    
+    with file_lock('engagement.json.lock'):
+        # 先更新汇总统计，失败时放回缓冲区等待下次重试，缓冲区放不下的部分计入丢弃数
+        try:
+            engagement = load_engagement()
+            aggregate_tracking_events(engagement, events)
+            save_engagement(engagement)
+        except (OSError, PermissionError) as e:
+            overflow = len(events) + len(tracking_events) - TRACKING_BUFFER_SIZE
+            if overflow > 0:
+                tracking_stats['dropped'] += overflow
+            tracking_events.extendleft(reversed(events))
+            logger.warning(f"跟踪事件写入失败: {e}，{len(events)} 条事件已放回缓冲区")
+            return 0
+        
+        # 事件明细只追加写入，汇总统计已更新，写入失败时不再重试，避免重复计数
+        try:
+            with open(EVENTS_PATH, 'a', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(event, ensure_ascii=False) + '\n' for event in events))
+        except (OSError, PermissionError) as e:
+            logger.warning(f"跟踪事件明细写入失败: {e}")
+    
+    logger.info(f"跟踪事件写入成功，共 {len(events)} 条")
+    return len(events)
+
+# 检查事件格式，事件文件中格式错误的行（如多进程同时追加产生的片段）直接跳过
+def is_valid_tracking_event(event):
+    return (isinstance(event, dict)
+            and isinstance(event.get('token'), str)
+            and isinstance(event.get('at'), str)
+            and event.get('type') in TRACKING_EVENT_TYPES)
+
+# 将事件累加到汇总统计
+def aggregate_tracking_events(engagement, events):
+    for event in events:
+        if not is_valid_tracking_event(event):
+            continue
+        if engagement['since'] is None:
+            engagement['since'] = event['at']
+        stats = engagement['subscribers'].setdefault(
+            event['token'], {"opens": 0, "clicks": 0, "last_event_at": None}
+        )
+        stats['opens' if event['type'] == 'open' else 'clicks'] += 1
+        # 事件按时间追加写入，最后一条即最近一次
+        stats['last_event_at'] = event['at']
+
+# 从事件明细文件重建汇总统计（汇总文件缺失或损坏时使用）
+def rebuild_engagement():
+    engagement = {"since": None, "subscribers": {}}
+    try:
+        with open(EVENTS_PATH, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                aggregate_tracking_events(engagement, [event])
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        logger.error(f"邮件发送失败: {e}")
+        logger.warning(f"跟踪事件文件加载失败: {e}")
+    return engagement
+
+# 加载每个订阅用户的打开/点击汇总统计
+def load_engagement():
+    try:
+        with open(ENGAGEMENT_PATH, 'r', encoding='utf-8') as f:
+            engagement = json.load(f)
+        if (isinstance(engagement, dict) and 'since' in engagement
+                and isinstance(engagement.get('subscribers'), dict)):
+            return engagement
+        logger.warning("跟踪汇总文件格式错误，从事件文件重建")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning(f"跟踪汇总文件加载失败: {e}，从事件文件重建")
+    return rebuild_engagement()
+
+# 保存汇总统计（先写临时文件再替换），写入失败时抛出异常由调用方处理
+def save_engagement(engagement):
+    tmp_path = f"{ENGAGEMENT_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(engagement, f, ensure_ascii=False)
+    os.replace(tmp_path, ENGAGEMENT_PATH)
+
+# 查询订阅用户的打开/点击情况
+def get_engagement(email, secret, engagement=None):
+    if engagement is None:
+        engagement = load_engagement()
+    return engagement['subscribers'].get(subscriber_token(email, secret), {"opens": 0, "clicks": 0, "last_event_at": None})
+
+# 解析ISO格式时间，格式错误时返回None；带时区的时间转换为本地时间
+def parse_datetime(value):
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+# 判断订阅用户是否长期未打开/点击（从开始跟踪或订阅时起算），时间无法解析时按活跃处理
+def is_inactive(subscriber, engagement, tracking_config):
+    inactive_days = tracking_config['inactive_days']
+    if not inactive_days:
+        return False
+    
+    since = parse_datetime(engagement['since'])
+    if since is None:
         return False
+    
+    candidates = [since]
+    for value in (subscriber.get('created_at'),
+                  engagement['subscribers'].get(subscriber_token(subscriber['email'], tracking_config['secret']), {})
+                  .get('last_event_at')):
+        if value is None:
+            continue
+        parsed = parse_datetime(value)
+        if parsed is None:
+            return False
+        candidates.append(parsed)
+    
+    return datetime.datetime.now() - max(candidates) > datetime.timedelta(days=inactive_days)
 
 # 爬取新浪新闻
 def crawl_sina_news():
@@ -270,6 +673,10 @@ def generate_news_content():
     news_list = get_real_time_news()
     logger.info(f"获取到 {len(news_list)} 条新闻")
     
+    return render_news_content(news_list)
+
+# 将新闻列表渲染为邮件HTML
+def render_news_content(news_list):
     content = f"""
     <html>
     <body>
@@ -303,6 +710,10 @@ def generate_news_content():
         
         content += "<hr>"
     
+    tracking_config = build_tracking_config(load_config())
+    if tracking_config['enabled']:
+        content = add_tracking(content, tracking_config)
+    
     content += """
         <p> unsubscribe: <a href="http://your-domain.com/unsubscribe">取消订阅</a></p>
     </body>
@@ -312,33 +723,233 @@ def generate_news_content():
     logger.info("新闻邮件内容生成完成")
     return content
 
+# 每累计多少条投递结果写回一次订阅数据，进程中断时最多丢失一个批次（分片发送可从发送记录重放）
+DELIVERY_BATCH_SIZE = 50
+
+# 构建一条投递记录
+def build_delivery_record(email, success, failure_type):
+    return {
+        "email": email,
+        "success": success,
+        "failure_type": failure_type,
+        "at": datetime.datetime.now().isoformat()
+    }
+
+# 获取有连续失败计数的地址（规范化），这些地址发送成功时需要清零计数
+def load_failing_addresses(subscribers):
+    return {normalize_email(s['email']) for s in subscribers.get('subscribers', []) if s.get('consecutive_failures')}
+
+# 判断投递记录是否可能改变订阅数据：收件人失败，或有失败计数的地址发送成功
+# 其余记录（大多数成功投递）不需要写回，避免每批发送都重写订阅数据文件
+def affects_subscriber(record, failing_addresses):
+    if record['success']:
+        return normalize_email(record['email']) in failing_addresses
+    return record['failure_type'] is not None
+
+# 批量应用投递记录，只有计数或状态实际变化时才返回True
+# 可重复应用：早于最近一次失败的记录视为已应用；同一 run_id 内每个地址最多计一次失败
+def apply_delivery_results(subscribers, records, bounce_config, run_id=None):
+    by_email = {normalize_email(s['email']): s for s in subscribers.get('subscribers', [])}
+    changed = False
+    for record in sorted(records, key=lambda r: r['at']):
+        subscriber = by_email.get(normalize_email(record['email']))
+        if not subscriber:
+            continue
+        
+        last_failure_at = subscriber.get('last_failure_at') or ''
+        if record['success']:
+            # 早于最近一次失败的成功记录（如重放旧的发送记录）不能清零计数
+            if record['at'] < last_failure_at:
+                continue
+        elif record['at'] <= last_failure_at or (run_id and subscriber.get('failure_counted_run') == run_id):
+            # 已应用过的失败记录，或同一次运行中重试后再次失败，不重复计数
+            continue
+        
+        if record_delivery_result(subscriber, record['success'], record['failure_type'], bounce_config, record['at']):
+            changed = True
+            if not record['success'] and run_id:
+                subscriber['failure_counted_run'] = run_id
+    return changed
+
+# 加锁重新读取订阅数据并应用投递记录，避免覆盖期间其他写入（如新订阅）
+def update_subscribers(records, bounce_config, run_id=None):
+    if not records:
+        return
+    with subscribers_lock():
+        subscribers = load_subscribers()
+        if apply_delivery_results(subscribers, records, bounce_config, run_id):
+            save_subscribers(subscribers)
+
+# 默认的预热配置
+DEFAULT_SCHEDULE_CONFIG = {
+    "hour": 9,
+    "minute": 0,
+    "prewarm_minutes": 15,        # 在发送前多少分钟预热摘要快照
+    "snapshot_max_age_minutes": 60  # 快照超过该时长视为过期
+}
+
+# 合并默认值生成定时任务配置，数值类型或范围错误时记录错误并使用默认配置
+def load_schedule_config(config):
+    schedule_config = {**DEFAULT_SCHEDULE_CONFIG, **(config.get('schedule') or {})}
+    limits = {
+        "hour": (0, 23),
+        "minute": (0, 59),
+        "prewarm_minutes": (0, 24 * 60),
+        "snapshot_max_age_minutes": (1, 24 * 60)
+    }
+    for key, (low, high) in limits.items():
+        value = schedule_config[key]
+        if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+            logger.error(f"定时任务配置错误: {key} 应为 {low} 到 {high} 之间的整数，当前为 {value!r}，使用默认配置")
+            return dict(DEFAULT_SCHEDULE_CONFIG)
+    return schedule_config
+
+# 检查预热配置：预热提前量不小于快照有效期时，快照在发送时总是已过期
+def validate_schedule_config(schedule_config):
+    if schedule_config['prewarm_minutes'] >= schedule_config['snapshot_max_age_minutes']:
+        logger.warning(
+            f"预热配置错误: prewarm_minutes ({schedule_config['prewarm_minutes']}) 应小于 "
+            f"snapshot_max_age_minutes ({schedule_config['snapshot_max_age_minutes']})，"
+            f"否则发送时快照总是过期，将改为实时获取新闻"
+        )
+        return False
+    return True
+
+# 获取发送时间与预热时间：(发送小时, 发送分钟, 预热小时, 预热分钟)
+def get_schedule_times(config):
+    schedule_config = load_schedule_config(config)
+    validate_schedule_config(schedule_config)
+    send_time = datetime.datetime.combine(
+        datetime.date.today(),
+        datetime.time(schedule_config['hour'], schedule_config['minute'])
+    )
+    prewarm_time = send_time - datetime.timedelta(minutes=schedule_config['prewarm_minutes'])
+    return send_time.hour, send_time.minute, prewarm_time.hour, prewarm_time.minute
+
+# 生成邮件主题
+def build_subject(config):
+    return f"{config['email']['subject']} - {datetime.datetime.now().strftime('%Y-%m-%d')}"
+
+# 预热：获取新闻、渲染并MIME编码邮件摘要，快照保存到news.json
+def prewarm_digest():
+    logger.info("开始预热新闻摘要快照...")
+    news_list = get_real_time_news()
+    content = render_news_content(news_list)
+    
+    snapshot = {
+        **build_digest(content),
+        "generated_at": datetime.datetime.now().isoformat()
+    }
+    save_news({
+        "news": news_list,
+        "last_updated": snapshot['generated_at'],
+        "digest": snapshot
+    })
+    
+    logger.info(f"新闻摘要快照预热完成，共 {len(news_list)} 条新闻")
+    return snapshot
+
+# 加载预热的摘要快照，快照缺失或过期时返回None
+def load_digest_snapshot(config):
+    snapshot = load_news().get('digest')
+    if not snapshot:
+        logger.info("未找到预热的新闻摘要快照")
+        return None
+    
+    schedule_config = load_schedule_config(config)
+    try:
+        generated_at = datetime.datetime.fromisoformat(snapshot['generated_at'])
+    except (KeyError, TypeError, ValueError):
+        logger.warning("新闻摘要快照格式错误，忽略")
+        return None
+    
+    age = datetime.datetime.now() - generated_at
+    if age > datetime.timedelta(minutes=schedule_config['snapshot_max_age_minutes']):
+        logger.info(f"新闻摘要快照已过期（生成于 {snapshot['generated_at']}）")
+        validate_schedule_config(schedule_config)
+        return None
+    
+    logger.info(f"使用预热的新闻摘要快照（生成于 {snapshot['generated_at']}）")
+    return snapshot
+
+# 获取本次发送的邮件摘要：优先使用预热快照，否则实时获取
+def get_digest(config):
+    snapshot = load_digest_snapshot(config)
+    if snapshot:
+        return snapshot
+    
+    logger.info("实时生成新闻摘要...")
+    content = generate_news_content()
+    return build_digest(content)
+
+# 获取预热快照，快照缺失或过期时加锁预热一次：多个进程（如独立运行的分片）同时启动时，
+# 只有第一个进程抓取新闻，其余进程在锁释放后读取同一份快照，保证本次发送使用相同的邮件摘要
+def ensure_digest_snapshot(config):
+    snapshot = load_digest_snapshot(config)
+    if snapshot:
+        return snapshot
+    
+    with file_lock('news.json.lock'):
+        snapshot = load_digest_snapshot(config)
+        if snapshot:
+            return snapshot
+        return prewarm_digest()
+
 # 定时发送新闻
 def send_daily_news():
     logger.info("开始执行定时发送新闻任务...")
     
     subscribers = load_subscribers()
     config = load_config()
+    bounce_config = {**DEFAULT_BOUNCE_CONFIG, **config.get('bounce', {})}
+    tracking_config = build_tracking_config(config)
+    suppression_list = load_suppression_list(subscribers)
     
     active_subscribers = [s for s in subscribers.get('subscribers', []) if s['status'] == 'active']
-    logger.info(f"找到 {len(active_subscribers)} 个活跃订阅用户")
+    logger.info(f"找到 {len(active_subscribers)} 个活跃订阅用户，屏蔽列表共 {len(suppression_list)} 个地址")
+    
+    if tracking_config['enabled'] and tracking_config['inactive_days']:
+        engagement = load_engagement()
+        inactive = {s['email'] for s in active_subscribers if is_inactive(s, engagement, tracking_config)}
+        if inactive:
+            logger.info(f"跳过 {len(inactive)} 个超过 {tracking_config['inactive_days']} 天未打开邮件的用户")
+            active_subscribers = [s for s in active_subscribers if s['email'] not in inactive]
     
+    digest = get_digest(config)
+    subject = build_subject(config)
+    logger.info(f"生成邮件主题: {subject}")
+    
+    # 同一天内多次发送（如手动触发）每个地址最多计一次失败
+    run_id = datetime.date.today().isoformat()
+    failing_addresses = load_failing_addresses(subscribers)
+    records = []
     for subscriber in active_subscribers:
         email = subscriber['email']
+        # 屏蔽按地址而不是按记录：同一地址的其他写法（如大小写不同）被屏蔽时同样跳过
+        if normalize_email(email) in suppression_list:
+            logger.info(f"跳过已屏蔽的邮箱: {email}")
+            continue
         logger.info(f"准备发送新闻到: {email}")
         
         try:
-            content = generate_news_content()
-            subject = f"{config['email']['subject']} - {datetime.datetime.now().strftime('%Y-%m-%d')}"
-            logger.info(f"生成邮件主题: {subject}")
-            
-            success = send_email(email, subject, content)
+            content, encoded_body = personalize_digest(digest, email, tracking_config['secret'])
+            success, failure_type = deliver_email(email, subject, content, encoded_body)
             if success:
                 logger.info(f"新闻邮件发送成功到: {email}")
             else:
-                logger.warning(f"新闻邮件发送失败到: {email}")
+                logger.warning(f"新闻邮件发送失败到: {email}（失败类型: {failure_type}）")
+            
+            record = build_delivery_record(email, success, failure_type)
+            if affects_subscriber(record, failing_addresses):
+                records.append(record)
+            if len(records) >= DELIVERY_BATCH_SIZE:
+                update_subscribers(records, bounce_config, run_id)
+                records = []
         except Exception as e:
             logger.error(f"发送邮件到 {email} 时发生错误: {e}")
     
+    update_subscribers(records, bounce_config, run_id)
+    
     logger.info("定时发送新闻任务执行完成")
 
 # 订阅接口
@@ -357,25 +968,41 @@ def subscribe():
             logger.warning("订阅失败: 邮箱不能为空")
             return jsonify({"status": "error", "message": "邮箱不能为空"}), 400
         
-        subscribers = load_subscribers()
-        
-        # 检查是否已订阅
-        for subscriber in subscribers['subscribers']:
-            if subscriber['email'] == email:
+        with subscribers_lock():
+            subscribers = load_subscribers()
+            
+            # 检查是否已订阅
+            existing = None
+            for subscriber in subscribers['subscribers']:
+                if normalize_email(subscriber['email']) == normalize_email(email):
+                    existing = subscriber
+                    break
+            
+            if existing and existing['status'] != 'suppressed':
                 logger.warning(f"订阅失败: 邮箱 {email} 已订阅")
                 return jsonify({"status": "error", "message": "该邮箱已订阅"}), 400
-        
-        # 添加新订阅
-        new_subscriber = {
-            "email": email,
-            "status": "active",
-            "created_at": datetime.datetime.now().isoformat(),
-            "updated_at": datetime.datetime.now().isoformat()
-        }
-        
-        subscribers['subscribers'].append(new_subscriber)
-        save_subscribers(subscribers)
-        logger.info(f"订阅成功: 添加新用户 {email}")
+            
+            if existing:
+                # 被自动屏蔽的地址重新订阅时解除屏蔽并清零失败计数
+                existing['status'] = 'active'
+                existing['consecutive_failures'] = 0
+                for field in ('suppressed_at', 'last_failure_type', 'last_failure_at', 'failure_counted_run'):
+                    existing.pop(field, None)
+                existing['updated_at'] = datetime.datetime.now().isoformat()
+                save_subscribers(subscribers)
+                logger.info(f"订阅成功: 解除屏蔽用户 {email}")
+            else:
+                # 添加新订阅
+                new_subscriber = {
+                    "email": email,
+                    "status": "active",
+                    "created_at": datetime.datetime.now().isoformat(),
+                    "updated_at": datetime.datetime.now().isoformat()
+                }
+                
+                subscribers['subscribers'].append(new_subscriber)
+                save_subscribers(subscribers)
+                logger.info(f"订阅成功: 添加新用户 {email}")
         
         # 发送确认邮件
         content = """
@@ -412,21 +1039,22 @@ def unsubscribe():
             logger.warning("取消订阅失败: 邮箱不能为空")
             return jsonify({"status": "error", "message": "邮箱不能为空"}), 400
         
-        subscribers = load_subscribers()
-        found = False
-        
-        for subscriber in subscribers['subscribers']:
-            if subscriber['email'] == email:
-                subscriber['status'] = 'inactive'
-                subscriber['updated_at'] = datetime.datetime.now().isoformat()
-                found = True
-                break
-        
-        if not found:
-            logger.warning(f"取消订阅失败: 邮箱 {email} 未订阅")
-            return jsonify({"status": "error", "message": "该邮箱未订阅"}), 400
-        
-        save_subscribers(subscribers)
+        with subscribers_lock():
+            subscribers = load_subscribers()
+            found = False
+            
+            for subscriber in subscribers['subscribers']:
+                if normalize_email(subscriber['email']) == normalize_email(email):
+                    subscriber['status'] = 'inactive'
+                    subscriber['updated_at'] = datetime.datetime.now().isoformat()
+                    found = True
+                    break
+            
+            if not found:
+                logger.warning(f"取消订阅失败: 邮箱 {email} 未订阅")
+                return jsonify({"status": "error", "message": "该邮箱未订阅"}), 400
+            
+            save_subscribers(subscribers)
         logger.info(f"取消订阅成功: {email}")
         return jsonify({"status": "success", "message": "取消订阅成功"}), 200
     except Exception as e:
@@ -461,6 +1089,31 @@ def send_news_manual():
         logger.error(f"手动发送邮件失败: {e}")
         return jsonify({"status": "error", "message": f"邮件发送失败: {str(e)}"}), 500
 
+# 邮件打开跟踪接口
+@app.route('/track/open', methods=['GET'])
+def track_open():
+    token = request.args.get('s')
+    if is_valid_token(token):
+        record_tracking_event('open', token)
+    response = app.response_class(TRACKING_PIXEL, mimetype='image/gif')
+    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+    return response
+
+# 链接点击跟踪接口
+@app.route('/track/click', methods=['GET'])
+def track_click():
+    url = request.args.get('u', '')
+    sig = request.args.get('sig', '')
+    secret = get_tracking_config()['secret']
+    if not secret or not url.startswith(('http://', 'https://')) or \
+            not hmac.compare_digest(sig, sign_tracking_url(url, secret)):
+        return jsonify({"status": "error", "message": "无效的跟踪链接"}), 400
+    
+    token = request.args.get('s')
+    if is_valid_token(token):
+        record_tracking_event('click', token, url)
+    return redirect(url, code=302)
+
 # 前端页面
 @app.route('/')
 def index():
@@ -468,9 +1121,19 @@ def index():
     return render_template('index.html')
 
 # 启动定时任务
+try:
+    startup_config = load_config()
+except Exception:
+    # 配置文件缺失或格式错误时按默认时间调度，任务执行时会再次加载配置并记录错误
+    startup_config = {}
+send_hour, send_minute, prewarm_hour, prewarm_minute = get_schedule_times(startup_config)
 scheduler = BackgroundScheduler()
-scheduler.add_job(send_daily_news, 'cron', hour=9, minute=0)  # 每天早上9:00发送
+scheduler.add_job(prewarm_digest, 'cron', hour=prewarm_hour, minute=prewarm_minute)  # 发送前预热新闻摘要
+scheduler.add_job(send_daily_news, 'cron', hour=send_hour, minute=send_minute)  # 默认每天早上9:00发送
+scheduler.add_job(flush_tracking_events, 'interval',
+                  seconds=build_tracking_config(startup_config)['flush_interval_seconds'])  # 批量写入跟踪事件
 scheduler.start()
+atexit.register(flush_tracking_events)
 
 if __name__ == '__main__':
     # 支持Vercel环境的端口配置
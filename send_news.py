@@ -1,12 +1,237 @@
 import sys
 import os
+import json
+import glob
+import hashlib
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 # 添加项目根目录到Python路径
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from app import send_daily_news
+from app import (
+    send_daily_news, prewarm_digest, load_config, load_subscribers,
+    load_suppression_list, normalize_email, ensure_digest_snapshot, deliver_email, build_subject,
+    build_delivery_record, update_subscribers, load_failing_addresses, affects_subscriber, build_tracking_config, load_engagement, is_inactive,
+    personalize_digest, DEFAULT_BOUNCE_CONFIG, DELIVERY_BATCH_SIZE, FAILURE_PERMANENT, PROJECT_ROOT, logger
+)
+
+# 分片发送记录目录：runs/<run_id>/shard-<k>-of-<n>.jsonl
+RUNS_DIR = os.path.join(PROJECT_ROOT, 'runs')
+
+# 按邮箱的稳定哈希计算所属分片（不使用内置hash，避免进程间随机化）
+def shard_of(email, shard_count):
+    digest = hashlib.md5(normalize_email(email).encode('utf-8')).hexdigest()
+    return int(digest, 16) % shard_count
+
+# 获取本次运行的记录目录
+def get_run_dir(run_id):
+    return os.path.join(RUNS_DIR, run_id)
+
+# 读取本次运行所有分片的发送记录
+def load_run_records(run_dir):
+    records = []
+    for path in sorted(glob.glob(os.path.join(run_dir, 'shard-*.jsonl'))):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # 进程中断可能留下不完整的最后一行
+                    logger.warning(f"忽略无法解析的发送记录: {path}")
+    return records
+
+# 获取本次运行中已完成的邮箱（已发送或永久失败），与分片数无关，保证不重复发送
+def load_completed_addresses(run_dir):
+    return {
+        r['email'] for r in load_run_records(run_dir)
+        if r['success'] or r.get('failure_type') == FAILURE_PERMANENT
+    }
+
+# 发送单个分片，可重复执行：已完成的邮箱会被跳过
+def run_shard(shard_index, shard_count, run_id, max_sends=None):
+    logger.info(f"开始发送分片 {shard_index}/{shard_count}（运行ID: {run_id}）")
+    config = load_config()
+    bounce_config = {**DEFAULT_BOUNCE_CONFIG, **config.get('bounce', {})}
+
+    run_dir = get_run_dir(run_id)
+    os.makedirs(run_dir, exist_ok=True)
+
+    # 重放本分片地址的已有发送记录，补上中断前未写回的失败计数（重复应用是安全的）
+    failing_addresses = load_failing_addresses(load_subscribers())
+    update_subscribers(
+        [r for r in load_run_records(run_dir)
+         if shard_of(r['email'], shard_count) == shard_index and affects_subscriber(r, failing_addresses)],
+        bounce_config, run_id
+    )
+    completed = load_completed_addresses(run_dir)
+
+    subscribers = load_subscribers()
+    failing_addresses = load_failing_addresses(subscribers)
+    suppression_list = load_suppression_list(subscribers)
+    pending = [
+        s for s in subscribers.get('subscribers', [])
+        if s['status'] == 'active'
+        and shard_of(s['email'], shard_count) == shard_index
+        and normalize_email(s['email']) not in suppression_list
+        and s['email'] not in completed
+    ]
+
+    # 跳过长期未打开/点击的用户
+    tracking_config = build_tracking_config(config)
+    if tracking_config['enabled'] and tracking_config['inactive_days']:
+        engagement = load_engagement()
+        pending = [s for s in pending if not is_inactive(s, engagement, tracking_config)]
+    pending = [s['email'] for s in pending]
+    logger.info(f"分片 {shard_index}/{shard_count} 待发送 {len(pending)} 个邮箱，已完成 {len(completed)} 个")
+
+    report = {"shard": shard_index, "shard_count": shard_count, "sent": 0, "failed": 0, "deferred": 0}
+    if not pending:
+        return report
+
+    digest = ensure_digest_snapshot(config)
+    subject = build_subject(config)
+
+    attempted = 0
+    records = []
+    ledger_path = os.path.join(run_dir, f"shard-{shard_index}-of-{shard_count}.jsonl")
+    with open(ledger_path, 'a', encoding='utf-8') as ledger:
+        for email in pending:
+            # 每个分片独立的SMTP发送预算，超出部分留给下次重启
+            if max_sends is not None and attempted >= max_sends:
+                report['deferred'] = len(pending) - attempted
+                logger.info(f"分片 {shard_index}/{shard_count} 达到发送上限 {max_sends}，剩余 {report['deferred']} 个邮箱待下次发送")
+                break
+
+            try:
+                content, encoded_body = personalize_digest(digest, email, tracking_config['secret'])
+                success, failure_type = deliver_email(email, subject, content, encoded_body)
+            except Exception as e:
+                logger.error(f"发送邮件到 {email} 时发生错误: {e}")
+                success, failure_type = False, None
+
+            attempted += 1
+            report['sent' if success else 'failed'] += 1
+            record = build_delivery_record(email, success, failure_type)
+            ledger.write(json.dumps({**record, "shard": shard_index, "shard_count": shard_count}, ensure_ascii=False) + "\n")
+            ledger.flush()
+
+            # 分批写回失败计数，中断时未写回的部分在下次启动时从发送记录重放
+            if affects_subscriber(record, failing_addresses):
+                records.append(record)
+            if len(records) >= DELIVERY_BATCH_SIZE:
+                update_subscribers(records, bounce_config, run_id)
+                records = []
+
+    update_subscribers(records, bounce_config, run_id)
+    logger.info(f"分片 {shard_index}/{shard_count} 发送完成: 成功 {report['sent']}，失败 {report['failed']}")
+    return report
+
+# 汇总本次运行所有分片的发送记录，生成运行报告并保存到 report.json
+def build_run_report(run_id):
+    run_dir = get_run_dir(run_id)
+    records = load_run_records(run_dir)
+
+    # 合并时重放全部发送记录，确保中断后未重启的分片的失败计数也被写回
+    bounce_config = {**DEFAULT_BOUNCE_CONFIG, **load_config().get('bounce', {})}
+    failing_addresses = load_failing_addresses(load_subscribers())
+    update_subscribers([r for r in records if affects_subscriber(r, failing_addresses)], bounce_config, run_id)
+
+    # 同一邮箱可能因临时失败后重试出现多条记录，以最后一条为准
+    latest = {}
+    for record in records:
+        latest[record['email']] = record
+
+    report = {
+        "run_id": run_id,
+        "attempts": len(records),
+        "sent": sum(1 for r in latest.values() if r['success']),
+        "failed": sum(1 for r in latest.values() if not r['success']),
+        "failures": {r['email']: r.get('failure_type') for r in latest.values() if not r['success']},
+        "generated_at": datetime.datetime.now().isoformat()
+    }
+
+    try:
+        os.makedirs(run_dir, exist_ok=True)
+        with open(os.path.join(run_dir, 'report.json'), 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    except (OSError, PermissionError) as e:
+        logger.warning(f"运行报告保存失败: {e}")
+
+    return report
+
+# 使用进程池并行发送所有分片
+def run_sharded(shard_count, run_id, workers=None, max_sends=None):
+    # 先确保摘要快照已预热，避免每个分片各自实时抓取
+    ensure_digest_snapshot(load_config())
+
+    with ProcessPoolExecutor(max_workers=workers or shard_count) as executor:
+        futures = [
+            executor.submit(run_shard, index, shard_count, run_id, max_sends)
+            for index in range(shard_count)
+        ]
+        for future in futures:
+            try:
+                shard_report = future.result()
+                print(f"  分片 {shard_report['shard']}/{shard_count}: 成功 {shard_report['sent']}，"
+                      f"失败 {shard_report['failed']}，待发送 {shard_report['deferred']}")
+            except Exception as e:
+                logger.error(f"分片发送失败: {e}")
+
+    return build_run_report(run_id)
 
 def main():
+    parser = argparse.ArgumentParser(description="发送每日新闻邮件")
+    parser.add_argument('--prewarm', action='store_true', help="仅预热新闻摘要快照，不发送邮件")
+    parser.add_argument('--shards', type=int, help="按邮箱哈希将订阅用户分为N个分片并行发送")
+    parser.add_argument('--shard', type=int, help="只发送指定编号的分片（0 到 N-1），需配合 --shards")
+    parser.add_argument('--workers', type=int, help="进程池大小，默认等于分片数")
+    parser.add_argument('--max-sends', type=int, help="每个分片本次最多发送的邮件数")
+    parser.add_argument('--run-id', default=datetime.date.today().isoformat(),
+                        help="运行ID，同一运行ID内每个邮箱只发送一次（默认当天日期）")
+    parser.add_argument('--report', action='store_true', help="汇总指定运行ID的发送报告")
+    args = parser.parse_args()
+
+    if args.prewarm:
+        print("开始预热新闻摘要快照...")
+        try:
+            prewarm_digest()
+            print("✅ 新闻摘要快照预热成功！")
+        except Exception as e:
+            print(f"❌ 预热失败: {e}")
+        return
+
+    if args.report:
+        report = build_run_report(args.run_id)
+        print(f"运行 {report['run_id']}: 成功 {report['sent']}，失败 {report['failed']}，共尝试 {report['attempts']} 次")
+        return
+
+    if args.shard is not None and not args.shards:
+        parser.error("--shard 需要配合 --shards 使用")
+    if args.shards is not None and args.shards < 1:
+        parser.error("--shards 必须大于0")
+    if args.shard is not None and not 0 <= args.shard < args.shards:
+        parser.error(f"--shard 必须在 0 到 {args.shards - 1} 之间")
+
+    if args.shards:
+        print(f"开始分片发送新闻邮件（分片数: {args.shards}，运行ID: {args.run_id}）...")
+        try:
+            if args.shard is not None:
+                shard_report = run_shard(args.shard, args.shards, args.run_id, args.max_sends)
+                print(f"分片 {args.shard}/{args.shards}: 成功 {shard_report['sent']}，"
+                      f"失败 {shard_report['failed']}，待发送 {shard_report['deferred']}")
+                report = build_run_report(args.run_id)
+            else:
+                report = run_sharded(args.shards, args.run_id, args.workers, args.max_sends)
+            print(f"✅ 运行 {report['run_id']}: 成功 {report['sent']}，失败 {report['failed']}")
+        except Exception as e:
+            print(f"❌ 发送失败: {e}")
+        return
+
     print("开始发送新闻邮件...")
     try:
         send_daily_news()
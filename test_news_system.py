@@ -10,8 +10,21 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from app import (
     load_config, load_subscribers, save_subscribers, 
     send_email, crawl_sina_news, get_international_news,
-    get_real_time_news, generate_news_content
+    get_real_time_news, generate_news_content,
+    classify_smtp_error, record_delivery_result, send_daily_news,
+    DEFAULT_BOUNCE_CONFIG, FAILURE_PERMANENT, FAILURE_TRANSIENT,
+    encode_html_body, build_html_part, get_schedule_times, get_digest,
+    app, add_tracking, personalize_digest, subscriber_token, sign_tracking_url,
+    tracking_events, record_tracking_event, flush_tracking_events, load_engagement, get_engagement, is_inactive,
+    TRACKING_TOKEN_PLACEHOLDER, save_news, validate_schedule_config,
+    apply_delivery_results, build_delivery_record, ensure_digest_snapshot,
+    build_digest, build_tracking_config, tracking_stats
 )
+import datetime
+import tempfile
+import shutil
+import send_news
+import smtplib
 
 class TestNewsSystem(unittest.TestCase):
     """新闻订阅系统单元测试"""
@@ -202,5 +215,427 @@ class TestNewsSystem(unittest.TestCase):
         self.assertIn('国内新闻', content)
         self.assertIn('测试新闻', content)
 
+    def test_classify_smtp_error(self):
+        """测试SMTP失败分类功能"""
+        refused = smtplib.SMTPRecipientsRefused({'a@qq.com': (550, b'Mailbox not found')})
+        self.assertEqual(classify_smtp_error(refused, 'a@qq.com'), FAILURE_PERMANENT)
+        
+        greylisted = smtplib.SMTPRecipientsRefused({'a@qq.com': (450, b'Try again later')})
+        self.assertEqual(classify_smtp_error(greylisted, 'a@qq.com'), FAILURE_TRANSIENT)
+        
+        # DATA阶段内容被拒、认证失败、网络异常属于发件方问题，不计入收件人失败
+        content_denied = smtplib.SMTPDataError(550, b'Mail content denied')
+        self.assertIsNone(classify_smtp_error(content_denied, 'a@qq.com'))
+        auth = smtplib.SMTPAuthenticationError(535, b'Login failed')
+        self.assertIsNone(classify_smtp_error(auth, 'a@qq.com'))
+        self.assertIsNone(classify_smtp_error(ConnectionRefusedError(), 'a@qq.com'))
+        self.assertIsNone(classify_smtp_error(TimeoutError(), 'a@qq.com'))
+        self.assertIsNone(classify_smtp_error(smtplib.SMTPServerDisconnected(), 'a@qq.com'))
+    
+    def test_record_delivery_result(self):
+        """测试连续失败计数与自动屏蔽功能"""
+        subscriber = {"email": "a@qq.com", "status": "active"}
+        
+        # 临时失败未达到阈值，不屏蔽
+        record_delivery_result(subscriber, False, FAILURE_TRANSIENT, DEFAULT_BOUNCE_CONFIG)
+        self.assertEqual(subscriber['consecutive_failures'], 1)
+        self.assertEqual(subscriber['status'], 'active')
+        
+        # 成功后计数清零
+        record_delivery_result(subscriber, True, None, DEFAULT_BOUNCE_CONFIG)
+        self.assertEqual(subscriber['consecutive_failures'], 0)
+        
+        # 永久失败立即屏蔽
+        record_delivery_result(subscriber, False, FAILURE_PERMANENT, DEFAULT_BOUNCE_CONFIG)
+        self.assertEqual(subscriber['status'], 'suppressed')
+    
+    @patch('app.save_subscribers')
+    @patch('app.load_news', return_value={"news": []})
+    @patch('app.generate_news_content', return_value='测试内容')
+    @patch('app.deliver_email')
+    def test_send_daily_news_suppression(self, mock_deliver, mock_generate, mock_load_news, mock_save):
+        """测试定时发送跳过屏蔽地址并持久化失败记录"""
+        subscribers = {
+            "subscribers": [
+                {"email": "ok@qq.com", "status": "active"},
+                {"email": "dead@qq.com", "status": "active"},
+                {"email": "gone@qq.com", "status": "suppressed"},
+                # 同一地址的另一条记录仍为active，由屏蔽列表拦截
+                {"email": "Gone@QQ.com ", "status": "active"}
+            ]
+        }
+        mock_deliver.side_effect = lambda email, subject, content, encoded_body: (
+            (True, None) if email == 'ok@qq.com' else (False, FAILURE_PERMANENT)
+        )
+        
+        with patch('app.load_subscribers', return_value=subscribers), \
+             patch('app.load_config', return_value=self.test_config):
+            send_daily_news()
+        
+        sent_to = [call.args[0] for call in mock_deliver.call_args_list]
+        self.assertEqual(sent_to, ['ok@qq.com', 'dead@qq.com'])
+        self.assertEqual(subscribers['subscribers'][1]['status'], 'suppressed')
+        mock_save.assert_called_once_with(subscribers)
+        # 邮件内容只生成一次，所有订阅用户复用
+        mock_generate.assert_called_once()
+    
+    @patch('app.send_email', return_value=True)
+    @patch('app.save_subscribers')
+    def test_subscribe_suppressed_address(self, mock_save, mock_send):
+        """测试被屏蔽的地址可以重新订阅"""
+        subscribers = {
+            "subscribers": [
+                {"email": "gone@qq.com", "status": "suppressed", "consecutive_failures": 1,
+                 "suppressed_at": "2026-01-01T00:00:00", "last_failure_type": FAILURE_PERMANENT,
+                 "last_failure_at": "2026-01-01T00:00:00", "failure_counted_run": "2026-01-01"},
+                {"email": "ok@qq.com", "status": "active"}
+            ]
+        }
+        client = app.test_client()
+        
+        with patch('app.load_subscribers', return_value=subscribers):
+            response = client.post('/subscribe', json={"email": "gone@qq.com"})
+            self.assertEqual(response.status_code, 200)
+            
+            response = client.post('/subscribe', json={"email": "ok@qq.com"})
+            self.assertEqual(response.status_code, 400)
+        
+        record = subscribers['subscribers'][0]
+        self.assertEqual(record['status'], 'active')
+        self.assertEqual(record['consecutive_failures'], 0)
+        for field in ('suppressed_at', 'last_failure_type', 'last_failure_at', 'failure_counted_run'):
+            self.assertNotIn(field, record)
+        self.assertEqual(len(subscribers['subscribers']), 2)
+    
+    @patch('app.save_subscribers')
+    def test_unsubscribe_normalized_email(self, mock_save):
+        """测试取消订阅时邮箱地址不区分大小写"""
+        subscribers = {"subscribers": [{"email": "a@qq.com", "status": "active"}]}
+        client = app.test_client()
+        
+        with patch('app.load_subscribers', return_value=subscribers):
+            response = client.post('/unsubscribe', json={"email": " A@QQ.com"})
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(subscribers['subscribers'][0]['status'], 'inactive')
+    
+    def test_encode_html_body(self):
+        """测试预编码正文与实时编码结果一致"""
+        content = '<h2>今日新闻</h2>'
+        html_part = build_html_part(encode_html_body(content))
+        self.assertEqual(html_part.get_content_type(), 'text/html')
+        self.assertEqual(html_part.get_payload(decode=True).decode('utf-8'), content)
+    
+    @patch('app.load_news')
+    def test_save_news_keeps_digest(self, mock_load_news):
+        """测试刷新新闻列表时保留预热的摘要快照"""
+        digest = {"content": '预热内容', "encoded_body": encode_html_body('预热内容'), "generated_at": "2026-01-26T08:45:00"}
+        mock_load_news.return_value = {"news": [], "digest": digest}
+        
+        with patch('app.open', unittest.mock.mock_open()) as mock_file, patch('app.os.replace'):
+            self.assertTrue(save_news({"news": [], "last_updated": "2026-01-26T08:50:00"}))
+        
+        written = ''.join(call.args[0] for call in mock_file().write.call_args_list)
+        self.assertEqual(json.loads(written)['digest'], digest)
+    
+    def test_validate_schedule_config(self):
+        """测试预热提前量必须小于快照有效期"""
+        self.assertTrue(validate_schedule_config({"prewarm_minutes": 15, "snapshot_max_age_minutes": 60}))
+        with self.assertLogs('app', level='WARNING'):
+            self.assertFalse(validate_schedule_config({"prewarm_minutes": 60, "snapshot_max_age_minutes": 30}))
+    
+    def test_get_schedule_times(self):
+        """测试预热时间计算功能"""
+        config = {"schedule": {"hour": 9, "minute": 0, "prewarm_minutes": 15}}
+        self.assertEqual(get_schedule_times(config), (9, 0, 8, 45))
+        self.assertEqual(get_schedule_times({}), (9, 0, 8, 45))
+        
+        # 配置类型或范围错误时使用默认配置，不抛出异常
+        for schedule in ({"prewarm_minutes": "15"}, {"hour": 24}, {"minute": None}):
+            with self.assertLogs('app', level='ERROR'):
+                self.assertEqual(get_schedule_times({"schedule": schedule}), (9, 0, 8, 45))
+    
+    @patch('app.generate_news_content', return_value='实时内容')
+    def test_get_digest(self, mock_generate):
+        """测试优先使用预热快照，过期时实时获取"""
+        fresh = {
+            "content": '预热内容',
+            "encoded_body": encode_html_body('预热内容'),
+            "generated_at": datetime.datetime.now().isoformat()
+        }
+        with patch('app.load_news', return_value={"news": [], "digest": fresh}):
+            digest = get_digest(self.test_config)
+            self.assertEqual(digest['content'], '预热内容')
+            mock_generate.assert_not_called()
+        
+        stale = dict(fresh, generated_at=(datetime.datetime.now() - datetime.timedelta(hours=3)).isoformat())
+        with patch('app.load_news', return_value={"news": [], "digest": stale}):
+            digest = get_digest(self.test_config)
+            self.assertEqual(digest['content'], '实时内容')
+            mock_generate.assert_called_once()
+
+    def test_shard_of(self):
+        """测试按邮箱哈希分片的稳定性"""
+        emails = [f"user{i}@qq.com" for i in range(100)]
+        shards = [send_news.shard_of(email, 4) for email in emails]
+        self.assertTrue(all(0 <= shard < 4 for shard in shards))
+        self.assertEqual(shards, [send_news.shard_of(email, 4) for email in emails])
+        self.assertEqual(send_news.shard_of('User0@QQ.com', 4), shards[0])
+    
+    def test_run_shard_skips_completed_addresses(self):
+        """测试分片数变化后重跑不会重复发送"""
+        runs_dir = tempfile.mkdtemp()
+        subscribers = {
+            "subscribers": [{"email": f"user{i}@qq.com", "status": "active"} for i in range(20)]
+        }
+        digest = {"content": '内容', "encoded_body": encode_html_body('内容')}
+        
+        try:
+            with patch.object(send_news, 'RUNS_DIR', runs_dir), \
+                 patch('send_news.load_config', return_value=self.test_config), \
+                 patch('send_news.load_subscribers', return_value=subscribers), \
+                 patch('send_news.ensure_digest_snapshot', return_value=digest), \
+                 patch('send_news.update_subscribers'), \
+                 patch('send_news.deliver_email', return_value=(True, None)) as mock_deliver:
+                # 第一次运行：2个分片，只完成分片0
+                send_news.run_shard(0, 2, 'test-run')
+                first_batch = {call.args[0] for call in mock_deliver.call_args_list}
+                
+                # 重启时改为3个分片，全部运行
+                mock_deliver.reset_mock()
+                for index in range(3):
+                    send_news.run_shard(index, 3, 'test-run')
+                second_batch = [call.args[0] for call in mock_deliver.call_args_list]
+                
+                report = send_news.build_run_report('test-run')
+        finally:
+            shutil.rmtree(runs_dir)
+        
+        self.assertFalse(first_batch & set(second_batch))
+        self.assertEqual(len(second_batch), len(set(second_batch)))
+        self.assertEqual(len(first_batch) + len(second_batch), 20)
+        self.assertEqual(report['sent'], 20)
+        self.assertEqual(report['failed'], 0)
+
+    def test_add_tracking(self):
+        """测试邮件链接改写与个性化跟踪标识"""
+        tracking_config = {"base_url": "http://news.test", "secret": "secret"}
+        content = add_tracking("<a href='https://news.sina.com.cn/a?x=1&y=2'>查看详情</a>", tracking_config)
+        self.assertIn('http://news.test/track/click?s=' + TRACKING_TOKEN_PLACEHOLDER, content)
+        self.assertIn('http://news.test/track/open?s=' + TRACKING_TOKEN_PLACEHOLDER, content)
+        self.assertNotIn("href='https://news.sina.com.cn", content)
+        
+        # 分段预编码后拼接的结果与对个性化内容直接编码一致
+        digest = build_digest("<p>今日新闻</p>" + content)
+        personalized, encoded_body = personalize_digest(digest, 'a@qq.com', 'secret')
+        self.assertIn(subscriber_token('a@qq.com', 'secret'), personalized)
+        self.assertNotIn(TRACKING_TOKEN_PLACEHOLDER, personalized)
+        self.assertEqual(encoded_body, encode_html_body(personalized))
+        self.assertEqual(build_html_part(encoded_body).get_payload(decode=True).decode('utf-8'), personalized)
+    
+    def test_build_tracking_config_requires_secret(self):
+        """测试开启跟踪时必须配置独立的签名密钥"""
+        config = dict(self.test_config, tracking={"enabled": True})
+        with self.assertLogs('app', level='ERROR'):
+            self.assertFalse(build_tracking_config(config)['enabled'])
+        self.assertEqual(build_tracking_config(config)['secret'], '')
+        
+        config = dict(self.test_config, tracking={"enabled": True, "secret": "secret"})
+        self.assertTrue(build_tracking_config(config)['enabled'])
+    
+    def test_tracking_endpoints(self):
+        """测试打开/点击跟踪接口"""
+        tracking_events.clear()
+        client = app.test_client()
+        url = 'https://news.sina.com.cn/a'
+        token = subscriber_token('a@qq.com', 'secret')
+        
+        with patch('app.get_tracking_config', return_value={"secret": "secret"}):
+            response = client.get('/track/open?s=' + token)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'image/gif')
+            
+            response = client.get('/track/click', query_string={
+                "s": token, "u": url, "sig": sign_tracking_url(url, 'secret')
+            })
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(response.headers['Location'], url)
+            
+            # 签名错误时不跳转
+            response = client.get('/track/click', query_string={"s": token, "u": url, "sig": "bad"})
+            self.assertEqual(response.status_code, 400)
+            
+            # 格式不正确的标识不记录事件，但仍正常响应
+            for bad_token in ('token1', 'x' * 1000, token.upper(), token + '0'):
+                response = client.get('/track/open', query_string={"s": bad_token})
+                self.assertEqual(response.status_code, 200)
+                response = client.get('/track/click', query_string={
+                    "s": bad_token, "u": url, "sig": sign_tracking_url(url, 'secret')
+                })
+                self.assertEqual(response.status_code, 302)
+        
+        self.assertEqual([e['type'] for e in tracking_events], ['open', 'click'])
+        self.assertEqual({e['token'] for e in tracking_events}, {token})
+        # 标识由密钥签名派生，不同密钥得到不同标识
+        self.assertNotEqual(subscriber_token('a@qq.com', 'other'), token)
+        self.assertEqual(subscriber_token(' A@qq.com ', 'secret'), token)
+        tracking_events.clear()
+    
+    def test_engagement(self):
+        """测试跟踪事件批量写入与用户活跃度汇总"""
+        events_dir = tempfile.mkdtemp()
+        events_path = os.path.join(events_dir, 'events.jsonl')
+        tracking_events.clear()
+        
+        try:
+            with patch('app.EVENTS_PATH', events_path), \
+                 patch('app.ENGAGEMENT_PATH', os.path.join(events_dir, 'engagement.json')):
+                old = (datetime.datetime.now() - datetime.timedelta(days=200)).isoformat()
+                tracking_events.append({"type": "open", "token": subscriber_token('old@qq.com', 'secret'), "url": None, "at": old})
+                tracking_events.append({"type": "open", "token": subscriber_token('a@qq.com', 'secret'), "url": None, "at": old})
+                self.assertEqual(flush_tracking_events(), 2)
+                tracking_events.append({
+                    "type": "click", "token": subscriber_token('a@qq.com', 'secret'), "url": "https://a.com",
+                    "at": datetime.datetime.now().isoformat()
+                })
+                self.assertEqual(flush_tracking_events(), 1)
+                self.assertEqual(len(tracking_events), 0)
+                
+                # 每次写入都会更新汇总文件，读取时无需扫描全部事件
+                with patch('app.rebuild_engagement') as mock_rebuild:
+                    engagement = load_engagement()
+                mock_rebuild.assert_not_called()
+                
+                # 汇总文件丢失时从事件文件重建，结果一致
+                os.remove(os.path.join(events_dir, 'engagement.json'))
+                self.assertEqual(load_engagement(), engagement)
+        finally:
+            shutil.rmtree(events_dir)
+        
+        stats = get_engagement('a@qq.com', 'secret', engagement)
+        self.assertEqual((stats['opens'], stats['clicks']), (1, 1))
+        tracking_config = {"inactive_days": 90, "secret": "secret"}
+        self.assertFalse(is_inactive({"email": "a@qq.com", "created_at": old}, engagement, tracking_config))
+        self.assertTrue(is_inactive({"email": "old@qq.com", "created_at": old}, engagement, tracking_config))
+        self.assertFalse(is_inactive({"email": "old@qq.com", "created_at": old}, engagement,
+                                     dict(tracking_config, inactive_days=0)))
+        # 时间格式错误时按活跃处理
+        self.assertFalse(is_inactive({"email": "old@qq.com", "created_at": "bad"}, engagement, tracking_config))
+        self.assertTrue(is_inactive({"email": "old@qq.com", "created_at": old + "+08:00"}, engagement, tracking_config))
+    
+    def test_rebuild_engagement_skips_bad_lines(self):
+        """测试事件文件中间的损坏行只跳过该行，不影响后续事件"""
+        events_dir = tempfile.mkdtemp()
+        events_path = os.path.join(events_dir, 'events.jsonl')
+        at = datetime.datetime.now().isoformat()
+        with open(events_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({"type": "open", "token": "t1", "url": None, "at": at}) + "\n")
+            f.write("{}\n")
+            f.write('{"type": "open", "tok\n')
+            f.write(json.dumps({"type": "open", "token": ["t"], "url": None, "at": at}) + "\n")
+            f.write(json.dumps({"type": "open", "token": "t2", "url": None, "at": at}) + "\n")
+        
+        try:
+            with patch('app.EVENTS_PATH', events_path), \
+                 patch('app.ENGAGEMENT_PATH', os.path.join(events_dir, 'engagement.json')):
+                engagement = load_engagement()
+        finally:
+            shutil.rmtree(events_dir)
+        
+        self.assertEqual(set(engagement['subscribers']), {'t1', 't2'})
+        self.assertEqual(engagement['subscribers']['t2']['opens'], 1)
+    
+    def test_flush_tracking_events_failure(self):
+        """测试跟踪事件写入失败时放回缓冲区，缓冲区溢出时记录丢弃数"""
+        tracking_events.clear()
+        tracking_stats['dropped'] = 0
+        
+        missing_dir = os.path.join(tempfile.gettempdir(), 'missing-dir')
+        with patch('app.EVENTS_PATH', os.path.join(missing_dir, 'events.jsonl')), \
+             patch('app.ENGAGEMENT_PATH', os.path.join(missing_dir, 'engagement.json')):
+            tracking_events.append({"type": "open", "token": "t", "url": None, "at": "2026-01-26T00:00:00"})
+            self.assertEqual(flush_tracking_events(), 0)
+            self.assertEqual(len(tracking_events), 1)
+        
+        with patch('app.TRACKING_BUFFER_SIZE', 1):
+            record_tracking_event('open', 't')
+        self.assertEqual(tracking_stats['dropped'], 1)
+        with self.assertLogs('app', level='WARNING'), patch('app.open', unittest.mock.mock_open()), \
+             patch('app.file_lock'), patch('app.load_engagement', return_value={"since": None, "subscribers": {}}), \
+             patch('app.save_engagement'):
+            flush_tracking_events()
+        self.assertEqual(tracking_stats['dropped'], 0)
+        tracking_events.clear()
+
+    def test_apply_delivery_results(self):
+        """测试投递记录可重复应用，同一运行内每个地址最多计一次失败"""
+        subscribers = {"subscribers": [{"email": "a@qq.com", "status": "active"}]}
+        bounce_config = {"permanent_failure_threshold": 1, "transient_failure_threshold": 2}
+        
+        # 没有失败计数时的成功投递不需要写回
+        success = build_delivery_record('a@qq.com', True, None)
+        self.assertFalse(apply_delivery_results(subscribers, [success], bounce_config, 'run-1'))
+        
+        first = build_delivery_record('a@qq.com', False, FAILURE_TRANSIENT)
+        self.assertTrue(apply_delivery_results(subscribers, [first], bounce_config, 'run-1'))
+        # 重放同一条记录不重复计数
+        self.assertFalse(apply_delivery_results(subscribers, [first], bounce_config, 'run-1'))
+        
+        # 同一运行重启后再次临时失败，不重复计数
+        retry = dict(first, at=(datetime.datetime.now() + datetime.timedelta(seconds=1)).isoformat())
+        apply_delivery_results(subscribers, [retry], bounce_config, 'run-1')
+        subscriber = subscribers['subscribers'][0]
+        self.assertEqual(subscriber['consecutive_failures'], 1)
+        self.assertEqual(subscriber['status'], 'active')
+        
+        # 下一次运行再次失败，达到阈值
+        next_run = dict(first, at=(datetime.datetime.now() + datetime.timedelta(seconds=2)).isoformat())
+        apply_delivery_results(subscribers, [next_run], bounce_config, 'run-2')
+        self.assertEqual(subscriber['consecutive_failures'], 2)
+        self.assertEqual(subscriber['status'], 'suppressed')
+        
+        # 重放早于最近一次失败的成功记录不清零计数
+        self.assertFalse(apply_delivery_results(subscribers, [dict(success, at=first['at'])], bounce_config, 'run-1'))
+        self.assertEqual(subscriber['consecutive_failures'], 2)
+    
+    @patch('app.prewarm_digest', return_value={"content": '预热内容'})
+    def test_ensure_digest_snapshot(self, mock_prewarm):
+        """测试快照缺失时只预热一次，获取锁后重新检查快照"""
+        snapshot = {"content": '其他进程预热的内容'}
+        with patch('app.load_digest_snapshot', side_effect=[None, snapshot]):
+            self.assertEqual(ensure_digest_snapshot(self.test_config), snapshot)
+        mock_prewarm.assert_not_called()
+        
+        with patch('app.load_digest_snapshot', side_effect=[None, None]):
+            self.assertEqual(ensure_digest_snapshot(self.test_config)['content'], '预热内容')
+        mock_prewarm.assert_called_once()
+    
+    def test_run_shard_replays_ledger(self):
+        """测试分片中断后重启时重放已有的发送记录"""
+        runs_dir = tempfile.mkdtemp()
+        subscribers = {"subscribers": [{"email": "dead@qq.com", "status": "active"}]}
+        record = build_delivery_record('dead@qq.com', False, FAILURE_PERMANENT)
+        
+        try:
+            run_dir = os.path.join(runs_dir, 'test-run')
+            os.makedirs(run_dir)
+            with open(os.path.join(run_dir, 'shard-0-of-1.jsonl'), 'w', encoding='utf-8') as f:
+                f.write(json.dumps(record) + "\n")
+            
+            with patch.object(send_news, 'RUNS_DIR', runs_dir), \
+                 patch('send_news.load_config', return_value=self.test_config), \
+                 patch('app.load_subscribers', return_value=subscribers), \
+                 patch('send_news.load_subscribers', return_value=subscribers), \
+                 patch('app.save_subscribers') as mock_save, \
+                 patch('send_news.deliver_email') as mock_deliver:
+                send_news.run_shard(0, 1, 'test-run')
+        finally:
+            shutil.rmtree(runs_dir)
+        
+        # 中断前的永久失败被写回，且不会重发
+        self.assertEqual(subscribers['subscribers'][0]['status'], 'suppressed')
+        mock_save.assert_called_once_with(subscribers)
+        mock_deliver.assert_not_called()
+
 if __name__ == '__main__':
     unittest.main()